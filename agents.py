@@ -2,7 +2,10 @@ import os
 import re
 import json
 import asyncio
-import requests
+import httpx
+from collections import OrderedDict
+from heapq import nlargest
+import orjson
 from slack_sdk.web.async_client import AsyncWebClient
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
@@ -10,6 +13,7 @@ from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from twilio.rest import Client
 from duckduckgo_search import DDGS
+from rank_bm25 import BM25L
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -20,10 +24,45 @@ TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN", "")
 TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER", "")
 SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN", "")
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
+GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 CREDENTIALS_PATH = os.path.join(BASE_DIR, 'credentials.json')
 TOKEN_PATH = os.path.join(BASE_DIR, 'token.json')
+CALENDAR_TIMEZONE = "Asia/Kolkata"
+ANSWER_CACHE_SIZE = 128
+KNOWLEDGE_TOP_K = 3
+
+# Shared client so Groq calls reuse pooled keep-alive connections
+_HTTP = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    timeout=60.0,
+    http2=True,
+)
+
+_SLACK_RE = re.compile(r'Post\s+["\'](.+?)["\']\s+to\s+(#[^\s]+)', re.IGNORECASE)
+_SANITIZE_RE = re.compile(r'[^a-zA-Z0-9_-]')
+_PHONE_RE = re.compile(r'(\+?\d[\d\s-]{9,15})')
+# Drops spaces and dashes from a matched number in one pass
+_DIGIT_KEEP = str.maketrans("", "", " -")
+_SEARCH_PREFIX_RE = re.compile(r'^(Search for|SearchAgent|find|tell me about)\s+', re.IGNORECASE)
+_WORD_RE = re.compile(r'\w+')
+# Words too common to say anything about relevance, e.g. the "what is" of every question
+_STOPWORDS = frozenset("""
+a an the and or but if of to in on at by for with from about as into over than then so
+is are was were be been being am do does did doing have has had having can could will would
+shall should may might must it its this that these those there here i me my we our you your
+he him his she her they them their what which who whom whose when where why how
+not no yes all any some each more most much many very just also only tell please
+""".split())
+
+def _tokenize(text: str) -> list[str]:
+    # Shared by the BM25 corpus and queries so "python?" matches "python"
+    return [word for word in _WORD_RE.findall(text.lower()) if word not in _STOPWORDS]
+
+def _write_sync(path: str, content: str):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
 
 class SlackAgent:
     def __init__(self, token: str):
@@ -32,7 +71,7 @@ class SlackAgent:
     # Renamed from 'run' to 'execute' to fix your error
     async def execute(self, action: str):
         # Improved regex to handle various quoting styles
-        m = re.search(r'Post\s+["\'](.+?)["\']\s+to\s+(#[^\s]+)', action, re.IGNORECASE)
+        m = _SLACK_RE.search(action)
         if m:
             msg, channel = m.groups()
             try:
@@ -46,60 +85,104 @@ class KnowledgeAgent:
     def __init__(self, directory="knowledge_base"):
         self.directory = os.path.join(BASE_DIR, directory)
         os.makedirs(self.directory, exist_ok=True)
-        self.knowledge = self._load_knowledge()
-
-    def _load_knowledge(self):
-        full_text = ""
+        # filename -> content, so adding a file doesn't re-read the whole KB
+        self._files: dict[str, str] = {}
         try:
-            if os.path.exists(self.directory):
-                for filename in os.listdir(self.directory):
-                    if filename.endswith(".txt"):
-                        with open(os.path.join(self.directory, filename), 'r', encoding="utf-8") as f:
-                            full_text += f.read() + "\n"
+            for filename in os.listdir(self.directory):
+                if filename.endswith(".txt"):
+                    self._files[filename] = self._read_file(filename)
         except Exception as e:
             print(f"Error loading knowledge: {e}")
-        return full_text
+        self.knowledge = "\n".join(self._files.values())
+        self._rebuild_index()
+        # LRU of answers keyed on (KB generation, normalized query); add_knowledge bumps
+        # the generation, so any KB change misses the cache without rehashing the KB
+        self._generation = 0
+        self._answer_cache: OrderedDict[tuple[int, str], str] = OrderedDict()
+
+    def _rebuild_index(self):
+        # BM25 over the KB files, so questions only send the most relevant ones to Groq.
+        # BM25L rather than Okapi: Okapi's IDF is 0 for a term in half of a small KB's files
+        self._docs = list(self._files.values())
+        corpus = [_tokenize(doc) for doc in self._docs]
+        self._bm25 = BM25L(corpus) if any(corpus) else None
+
+    def _read_file(self, filename: str) -> str:
+        with open(os.path.join(self.directory, filename), 'r', encoding="utf-8") as f:
+            return f.read()
 
     # ADDED: This fixes the 'no attribute add_knowledge' error
     async def add_knowledge(self, filename: str, content: str) -> str:
         # Sanitize filename
-        safe_name = re.sub(r'[^a-zA-Z0-9_-]', '_', filename)
+        safe_name = _SANITIZE_RE.sub('_', filename)
         file_path = os.path.join(self.directory, safe_name + ".txt")
         try:
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(content.strip())
-            # Reload knowledge so the next question can use this new info
-            self.knowledge = self._load_knowledge()
+            # Single thread hop for open+write so the event loop isn't blocked
+            await asyncio.to_thread(_write_sync, file_path, content.strip())
+            # Update the cache so the next question can use this new info
+            self._files[safe_name + ".txt"] = content.strip()
+            self.knowledge = "\n".join(self._files.values())
+            self._rebuild_index()
+            self._generation += 1
             return f"Knowledge successfully stored in {safe_name}.txt"
         except Exception as e:
             return f"Error saving knowledge: {str(e)}"
 
-    async def run(self, query: str) -> str:
-        if not self.knowledge:
+    async def run(self, query: str, on_token=None) -> str:
+        # on_token, if given, is awaited with each streamed piece of the answer
+        if not self._bm25:
             return "Knowledge base is empty. I don't have internal info on this."
+
+        normalized = " ".join(query.lower().split())
+        key = (self._generation, normalized)
+        if key in self._answer_cache:
+            self._answer_cache.move_to_end(key)
+            return self._answer_cache[key]
         
-        prompt = f"Context: {self.knowledge}\n\nQuestion: {query}\n\nAnswer only based on context:"
+        scores = self._bm25.get_scores(_tokenize(query))
+        matches = [(score, doc) for score, doc in zip(scores, self._docs) if score > 0]
+        if not matches:
+            return "I couldn't find anything about this in the knowledge base."
+        top = nlargest(KNOWLEDGE_TOP_K, matches, key=lambda pair: pair[0])
+        context = "\n".join(dict.fromkeys(doc for _, doc in top)) # Drops duplicate files
+        prompt = f"Context: {context}\n\nQuestion: {query}\n\nAnswer only based on context:"
         headers = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
         payload = {
             "model": "llama-3.3-70b-versatile",
-            "messages": [{"role": "user", "content": prompt}]
+            "messages": [{"role": "user", "content": prompt}],
+            "stream": True
         }
         
         try:
-            r = requests.post("https://api.groq.com/openai/v1/chat/completions", headers=headers, json=payload)
-            r.raise_for_status()
-            return r.json()['choices'][0]['message']['content'].strip()
+            parts = []
+            async with _HTTP.stream("POST", GROQ_API_URL, headers=headers, content=orjson.dumps(payload)) as r:
+                r.raise_for_status()
+                async for line in r.aiter_lines():
+                    if not line.startswith("data: ") or line == "data: [DONE]":
+                        continue
+                    delta = orjson.loads(line[6:])['choices'][0]['delta'].get('content') or ""
+                    if delta:
+                        parts.append(delta)
+                        if on_token: await on_token(delta)
+            answer = "".join(parts).strip()
+            self._answer_cache[key] = answer
+            if len(self._answer_cache) > ANSWER_CACHE_SIZE:
+                self._answer_cache.popitem(last=False)
+            return answer
         except Exception as e:
             return f"Knowledge retrieval error: {str(e)}"
 
 class SearchAgent:
+    def __init__(self):
+        # One long-lived session so searches reuse its connection pool
+        self._ddgs = DDGS()
+
     async def run(self, query: str) -> str:
         # CLEANING: Remove "Search for" or "SearchAgent" if the orchestrator passes it
-        clean_query = re.sub(r'^(Search for|SearchAgent|find|tell me about)\s+', '', query, flags=re.IGNORECASE).strip()
+        clean_query = _SEARCH_PREFIX_RE.sub('', query).strip()
         
         try:
-            with DDGS() as ddgs:
-                results = [r for r in ddgs.text(clean_query, max_results=3)]
+            results = await asyncio.to_thread(lambda: list(self._ddgs.text(clean_query, max_results=3)))
             if not results:
                 return f"No search results found on the web for '{clean_query}'."
             return "\n".join([f"{r['title']}: {r['body']}" for r in results])
@@ -109,32 +192,51 @@ class SearchAgent:
 class CalendarAgent:
     def __init__(self):
         self.scopes = ["https://www.googleapis.com/auth/calendar"]
+        # Credentials and service are kept across runs and only refreshed when expired
+        self.creds = self._load_creds()
+        self.service = None
+        # The shared service's httplib2.Http isn't thread-safe, so calendar calls run one at a time
+        self._lock = asyncio.Lock()
+
+    def _load_creds(self):
+        # A bad token.json only fails the calendar step, not server startup
+        try:
+            if os.path.exists(TOKEN_PATH):
+                return Credentials.from_authorized_user_file(TOKEN_PATH, self.scopes)
+        except Exception as e:
+            print(f"Error loading calendar credentials: {e}")
+        return None
+
+    def _build_service(self):
+        return build("calendar", "v3", credentials=self.creds, cache_discovery=False)
 
     async def run(self, event_details: dict):
         # Note: Changed parameter to dict to match orchestrator's _parse_calendar_action
-        creds = None
-        if os.path.exists(TOKEN_PATH):
-            creds = Credentials.from_authorized_user_file(TOKEN_PATH, self.scopes)
-        
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                creds.refresh(Request())
+        async with self._lock:
+            return await self._create_event(event_details)
+
+    async def _create_event(self, event_details: dict):
+        if not self.creds or not self.creds.valid:
+            if self.creds and self.creds.expired and self.creds.refresh_token:
+                await asyncio.to_thread(self.creds.refresh, Request())
             else:
                 if not os.path.exists(CREDENTIALS_PATH):
                     return "Error: credentials.json not found."
                 flow = InstalledAppFlow.from_client_secrets_file(CREDENTIALS_PATH, self.scopes)
-                creds = flow.run_local_server(port=0)
-            with open(TOKEN_PATH, "w") as token:
-                token.write(creds.to_json())
+                self.creds = await asyncio.to_thread(flow.run_local_server, port=0)
+                self.service = None
+            await asyncio.to_thread(_write_sync, TOKEN_PATH, self.creds.to_json())
 
         try:
-            service = build("calendar", "v3", credentials=creds)
+            if self.service is None:
+                self.service = await asyncio.to_thread(self._build_service)
             event = {
                 "summary": event_details.get("title", "AI Task"),
-                "start": {"dateTime": event_details.get("start_time"), "timeZone": "Asia/Kolkata"},
-                "end": {"dateTime": event_details.get("end_time"), "timeZone": "Asia/Kolkata"}
+                "start": {"dateTime": event_details.get("start_time"), "timeZone": CALENDAR_TIMEZONE},
+                "end": {"dateTime": event_details.get("end_time"), "timeZone": CALENDAR_TIMEZONE}
             }
-            created_event = service.events().insert(calendarId="primary", body=event).execute()
+            request = self.service.events().insert(calendarId="primary", body=event)
+            created_event = await asyncio.to_thread(request.execute)
             return f"Event created: {created_event.get('htmlLink')}"
         except Exception as e:
             return f"Calendar Error: {str(e)}"
@@ -145,17 +247,18 @@ class CommunicationAgent:
 
     async def run(self, action: str):
         # Matches phone number anywhere in the string
-        phone_match = re.search(r'(\+?\d[\d\s-]{9,15})', action)
+        phone_match = _PHONE_RE.search(action)
         
         if phone_match and self.client:
-            to_no = phone_match.group(1).replace(" ", "").replace("-", "")
+            to_no = phone_match.group(1).translate(_DIGIT_KEEP)
             if not to_no.startswith('+'): to_no = "+" + to_no
             
             # Message is the part after the phone number
-            msg_content = action.split(phone_match.group(1))[-1].strip(": ")
+            msg_content = action[phone_match.end():].strip(": ")
 
             try:
-                message = self.client.messages.create(
+                message = await asyncio.to_thread(
+                    self.client.messages.create,
                     body=msg_content[:160], 
                     from_=TWILIO_PHONE_NUMBER, 
                     to=to_no
@@ -1,11 +1,13 @@
 from fastapi import FastAPI, WebSocket, WebSocketDisconnect
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import asyncio
 import json
 import os
+from types import SimpleNamespace
+import orjson
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
@@ -17,7 +19,7 @@ import agents
 import orchestrator 
 
 # Sync the keys correctly
-orchestrator.GROQ_API_KEY = os.getenv('GROQ_API_KEY', '')
+orchestrator.set_api_key(os.getenv('GROQ_API_KEY', ''))
 agents.GROQ_API_KEY = os.getenv('GROQ_API_KEY', '')
 agents.SLACK_BOT_TOKEN = os.getenv('SLACK_BOT_TOKEN', '')
 agents.TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID', '')
@@ -27,7 +29,22 @@ agents.TWILIO_PHONE_NUMBER = os.getenv('TWILIO_PHONE_NUMBER', '')
 if not orchestrator.GROQ_API_KEY:
     print("FATAL ERROR: GROQ_API_KEY not found in .env")
 
-app = FastAPI()
+MAX_CONCURRENT_TASKS = 16
+
+# Built once and shared by every task so agents aren't re-initialised per request
+agent_bundle = SimpleNamespace(
+    knowledge=agents.KnowledgeAgent(),
+    search=agents.SearchAgent(),
+    calendar=agents.CalendarAgent(),
+    comm=agents.CommunicationAgent(),
+    slack=agents.SlackAgent(token=os.getenv("SLACK_BOT_TOKEN")),
+)
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+# Running orchestrations, and a cap on how many may run at once
+app.state.tasks: set[asyncio.Task] = set()
+app.state.sem = asyncio.Semaphore(MAX_CONCURRENT_TASKS)
 
 app.add_middleware(
     CORSMiddleware,
@@ -37,20 +54,43 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Seconds a single client may take to accept a frame before it is dropped
+SEND_TIMEOUT = 10
+
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: list[WebSocket] = []
+        self.active_connections: set[WebSocket] = set()
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        self.active_connections.add(websocket)
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.active_connections.discard(websocket)
     async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+        # Send to every client concurrently so one slow client doesn't hold up the rest
+        connections = list(self.active_connections)
+        results = await asyncio.gather(
+            *(asyncio.wait_for(c.send_text(message), SEND_TIMEOUT) for c in connections),
+            return_exceptions=True,
+        )
+        dead = [c for c, result in zip(connections, results) if isinstance(result, Exception)]
+        for connection in dead:
+            self.active_connections.discard(connection)
+        # Best-effort close so dead or stalled clients don't linger
+        await asyncio.gather(
+            *(asyncio.wait_for(c.close(code=1011), SEND_TIMEOUT) for c in dead),
+            return_exceptions=True,
+        )
+    async def broadcast_many(self, events: list[dict]):
+        # One encode and one frame per connection for a whole batch of events
+        await self.broadcast(orjson.dumps({"events": events}).decode())
 
 manager = ConnectionManager()
 
+@app.on_event("shutdown")
+async def close_http_clients():
+    await agents._HTTP.aclose()
+    await orchestrator._HTTP.aclose()
+
 class TaskRequest(BaseModel):
     prompt: str
 
@@ -58,8 +98,16 @@ class TaskRequest(BaseModel):
 async def create_task(task_request: TaskRequest):
     print(f"Received task: {task_request.prompt}")
     task_id = "task_12345"
-    orch_instance = orchestrator.TaskOrchestrator(task_id, task_request.prompt, manager)
-    asyncio.create_task(orch_instance.execute_plan())
+    orch_instance = orchestrator.TaskOrchestrator(task_id, task_request.prompt, manager, agents=agent_bundle)
+
+    async def _run():
+        async with app.state.sem:
+            await orch_instance.execute_plan()
+
+    # Keep a reference until the task finishes so it can't be garbage collected mid-run
+    t = asyncio.create_task(_run())
+    app.state.tasks.add(t)
+    t.add_done_callback(app.state.tasks.discard)
     return {"status": "Task received", "task_id": task_id}
 
 @app.websocket("/ws/{client_id}")
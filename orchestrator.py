@@ -1,17 +1,35 @@
 import os
 import re
-import json
+import math
+import orjson
+import random
 import asyncio
-import requests
+import httpx
 from datetime import datetime, timedelta
+from functools import partial
 from dotenv import load_dotenv
-# Ensure SynthesisAgent is imported if you decide to use it for cleaning data
-from agents import SlackAgent, KnowledgeAgent, SearchAgent, CalendarAgent, CommunicationAgent
 
 load_dotenv()
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "")
 GROQ_API_URL = "https://api.groq.com/openai/v1/chat/completions"
+GROQ_MAX_RETRIES = 5
+GROQ_MAX_BACKOFF = 30 # Seconds; caps how long a Retry-After can park a task
+
+# Shared client so planner calls reuse pooled keep-alive connections
+_HTTP = httpx.AsyncClient(
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+    timeout=60.0,
+    http2=True,
+)
+
+_CAL_TITLE_RE = re.compile(r'schedule\s+(?:a\s+)?(.+?)\s+for', re.IGNORECASE)
+_ADD_KNOW_RE = re.compile(r"knowledge:\s*['\"](.+?)['\"]\s*in\s+([^\s]+)", re.IGNORECASE)
+_FILENAME_RE = re.compile(r'[^a-zA-Z0-9]')
+
+_ONE_DAY = timedelta(days=1)
+_HALF_HOUR = timedelta(minutes=30)
+_ONE_HOUR = timedelta(hours=1)
 
 PLANNER_PROMPT_TEMPLATE = """
 You are an expert planning agent. Create a JSON plan for: "{user_prompt}"
@@ -26,120 +44,247 @@ Sequence Rule:
 1. If the user asks a question, use SearchAgent first.
 2. If SearchAgent is used, the system will automatically save it to KnowledgeAgent.
 3. Use CommunicationAgent or SlackAgent only after info is gathered.
+4. Give each step "depends_on": the 0-based indices of earlier steps whose results it needs (the first step is 0), or [] if it is independent.
 
-Respond with ONLY a JSON object: {{"steps": [{{"agent": "...", "action": "..."}}]}}
+Respond with ONLY a JSON object: {{"steps": [{{"agent": "SearchAgent", "action": "...", "depends_on": []}}, {{"agent": "SlackAgent", "action": "...", "depends_on": [0]}}]}}
 """
 
+async def _backoff(attempt, retry_after=None):
+    # Sleeps 2**attempt (or a sane Retry-After) plus jitter, so concurrent tasks don't retry in lockstep
+    delay = 2 ** attempt
+    if retry_after is not None:
+        try:
+            delay = float(retry_after)
+        except ValueError: # HTTP-date form
+            pass
+        if not math.isfinite(delay):
+            delay = 2 ** attempt
+    delay = min(max(delay, 0), GROQ_MAX_BACKOFF)
+    await asyncio.sleep(delay + random.random() * 0.3)
+
+# Only {user_prompt} varies, so the template is split once instead of formatted per call
+_PROMPT_PREFIX, _PROMPT_SUFFIX = (
+    part.replace("{{", "{").replace("}}", "}") for part in PLANNER_PROMPT_TEMPLATE.split("{user_prompt}")
+)
+
+# Strict structured output schema, so the planner always returns {"steps": [...]}
+PLAN_SCHEMA = {
+    "name": "plan",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "steps": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "agent": {"type": "string", "enum": ["KnowledgeAgent", "SearchAgent", "SlackAgent", "CalendarAgent", "CommunicationAgent"]},
+                        "action": {"type": "string"},
+                        "depends_on": {"type": "array", "items": {"type": "integer"}}
+                    },
+                    "required": ["agent", "action", "depends_on"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["steps"],
+        "additionalProperties": False
+    }
+}
+
+# Strict json_schema output is only offered on some Groq models, so the planner uses one of those
+PLANNER_MODEL = "openai/gpt-oss-120b"
+
+_PAYLOAD = {
+    "model": PLANNER_MODEL,
+    "response_format": {"type": "json_schema", "json_schema": PLAN_SCHEMA},
+    "temperature": 0.1
+}
+
+_HEADERS = {}
+
+def set_api_key(key: str):
+    # Rebuilds the cached Groq headers along with the key
+    global GROQ_API_KEY, _HEADERS
+    GROQ_API_KEY = key
+    _HEADERS = {"Authorization": f"Bearer {key}", "Content-Type": "application/json"}
+
+set_api_key(GROQ_API_KEY)
+
+# Agents that consume the previous step's result, so they always run on their own
+CONTEXT_AGENTS = {"CommunicationAgent", "SlackAgent"}
+
 class TaskOrchestrator:
-    def __init__(self, task_id: str, prompt: str, ws_manager):
+    def __init__(self, task_id: str, prompt: str, ws_manager, agents):
         self.task_id = task_id
         self.prompt = prompt
         self.ws_manager = ws_manager
-        self.knowledge_agent = KnowledgeAgent()
-        self.search_agent = SearchAgent()
-        self.calendar_agent = CalendarAgent()
-        self.communication_agent = CommunicationAgent()
-        self.slack_agent = SlackAgent(token=os.getenv("SLACK_BOT_TOKEN"))
+        # Agents are shared across tasks, see agent_bundle in main.py
+        self.knowledge_agent = agents.knowledge
+        self.search_agent = agents.search
+        self.calendar_agent = agents.calendar
+        self.communication_agent = agents.comm
+        self.slack_agent = agents.slack
         self.plan = []
+        self._pending = set() # Background auto-save tasks, kept referenced until done
+        # Agent name -> coroutine handling that agent's action
+        self._dispatch = {
+            "KnowledgeAgent": self._do_knowledge,
+            "SearchAgent": self._do_search,
+            "SlackAgent": self.slack_agent.execute,
+            "CommunicationAgent": self.communication_agent.run,
+            "CalendarAgent": self._do_calendar,
+        }
 
     async def _groq_request(self, user_prompt: str):
         if not GROQ_API_KEY:
             raise RuntimeError("Missing GROQ_API_KEY")
 
-        headers = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
-        payload = {
-            "model": "llama-3.3-70b-versatile",
-            "messages": [{"role": "user", "content": PLANNER_PROMPT_TEMPLATE.format(user_prompt=user_prompt)}],
-            "response_format": {"type": "json_object"},
-            "temperature": 0.1
-        }
+        content = _PROMPT_PREFIX + user_prompt + _PROMPT_SUFFIX
+        payload = {**_PAYLOAD, "messages": [{"role": "user", "content": content}]}
 
-        for attempt in range(3):
-            r = requests.post(GROQ_API_URL, headers=headers, json=payload, timeout=60)
-            if r.status_code == 429:
-                await asyncio.sleep(5)
+        # Exponential backoff with jitter, honouring Retry-After on rate limits
+        for attempt in range(GROQ_MAX_RETRIES):
+            try:
+                r = await _HTTP.post(GROQ_API_URL, headers=_HEADERS, content=orjson.dumps(payload))
+            except httpx.TransportError:
+                if attempt == GROQ_MAX_RETRIES - 1: raise
+                await _backoff(attempt)
                 continue
+            if attempt < GROQ_MAX_RETRIES - 1:
+                if r.status_code == 429:
+                    await _backoff(attempt, r.headers.get("Retry-After"))
+                    continue
+                if 500 <= r.status_code < 600:
+                    await _backoff(attempt)
+                    continue
             r.raise_for_status()
             break
         
-        result = r.json()["choices"][0]["message"]["content"]
-        parsed = json.loads(result)
-        return parsed.get("steps", parsed) if isinstance(parsed, dict) else parsed
+        result = orjson.loads(r.content)["choices"][0]["message"]["content"]
+        return orjson.loads(result)["steps"]
 
     def _parse_calendar_action(self, action: str):
-        title_match = re.search(r'schedule\s+(?:a\s+)?(.+?)\s+for', action, re.IGNORECASE)
+        title_match = _CAL_TITLE_RE.search(action)
         title = title_match.group(1).strip() if title_match else "Meeting"
-        start_time = datetime.now() + timedelta(days=1) if "tomorrow" in action.lower() else datetime.now() + timedelta(minutes=30)
-        start_time = start_time.replace(hour=10, minute=0)
-        return {"title": title, "start_time": start_time.isoformat(), "end_time": (start_time + timedelta(hours=1)).isoformat()}
+        base = datetime.now() + (_ONE_DAY if "tomorrow" in action.lower() else _HALF_HOUR)
+        start_time = base.replace(hour=10, minute=0, second=0, microsecond=0)
+        return {"title": title, "start_time": start_time.isoformat(), "end_time": (start_time + _ONE_HOUR).isoformat()}
+
+    @staticmethod
+    def _is_kb_question(step):
+        return step["agent"] == "KnowledgeAgent" and "add knowledge" not in step["action"].lower()
+
+    @staticmethod
+    def _writes_kb(step):
+        # SearchAgent results are auto-saved, "Add knowledge" steps write directly
+        return step["agent"] == "SearchAgent" or (step["agent"] == "KnowledgeAgent" and "add knowledge" in step["action"].lower())
+
+    def _step_deps(self, i):
+        deps = self.plan[i].get("depends_on")
+        if not isinstance(deps, list) or any(not isinstance(d, int) or not 0 <= d < i for d in deps):
+            return [i - 1] if i else [] # No usable 0-based hint from the planner, so keep plan order
+        return deps
+
+    def _plan_waves(self):
+        # Groups step indices into waves of steps that don't depend on each other
+        waves, current = [], []
+        for i, step in enumerate(self.plan):
+            deps = self._step_deps(i)
+            # KB questions must run after any step in the wave that writes to the KB, so they see its result
+            after_write = self._is_kb_question(step) and any(self._writes_kb(self.plan[j]) for j in current)
+            if step["agent"] in CONTEXT_AGENTS or after_write or any(d in current for d in deps):
+                if current: waves.append(current)
+                current = []
+            current.append(i)
+            if step["agent"] in CONTEXT_AGENTS:
+                waves.append(current)
+                current = []
+        if current: waves.append(current)
+        return waves
 
     async def execute_plan(self):
         try:
-            await self.ws_manager.broadcast(json.dumps({"type": "log", "agent": "PlannerAgent", "message": "Groq is planning...", "log_type": "info"}))
+            await self.ws_manager.broadcast(orjson.dumps({"type": "log", "agent": "PlannerAgent", "message": "Groq is planning...", "log_type": "info"}).decode())
             self.plan = await self._groq_request(self.prompt)
-            if not isinstance(self.plan, list): self.plan = [self.plan]
         except Exception as e:
-            await self.ws_manager.broadcast(json.dumps({"type": "log", "agent": "System", "message": f"Planning failed: {e}", "log_type": "error"}))
+            await self.ws_manager.broadcast(orjson.dumps({"type": "log", "agent": "System", "message": f"Planning failed: {e}", "log_type": "error"}).decode())
             return
 
-        await self.ws_manager.broadcast(json.dumps({"type": "plan", "steps": self.plan}))
+        await self.ws_manager.broadcast(orjson.dumps({"type": "plan", "steps": self.plan}).decode())
         
-        context = "" # This stores the result of the previous step to pass to the next
+        results = [""] * len(self.plan) # Each step's result, by plan index
         
-        for step in self.plan:
-            # We inject the 'context' (previous results) into the action if it's an action-based agent
-            agent_name = step["agent"]
-            action = step["action"]
-            
-            if context and agent_name in ["CommunicationAgent", "SlackAgent"]:
-                action = f"{action}. Info: {context}"
+        for wave in self._plan_waves():
+            steps = []
+            for i in wave:
+                agent_name = self.plan[i]["agent"]
+                action = self.plan[i]["action"]
+                
+                # We inject the results of the steps it depends on into the action if it's an action-based agent
+                if agent_name in CONTEXT_AGENTS:
+                    context = "\n".join(results[d] for d in self._step_deps(i) if results[d])
+                    if context:
+                        action = f"{action}. Info: {context}"
+                steps.append((agent_name, action))
 
-            result = await self._execute_step(agent_name, action)
-            context = result # Update context with the latest result
+            # Independent steps in a wave run concurrently
+            wave_results = await asyncio.gather(*(self._execute_step(agent_name, action) for agent_name, action in steps))
+            for i, result in zip(wave, wave_results):
+                results[i] = result
             
-        await self.ws_manager.broadcast(json.dumps({"type": "log", "agent": "System", "message": "All tasks done!", "log_type": "success"}))
+        if self._pending: await asyncio.gather(*self._pending)
+        await self.ws_manager.broadcast(orjson.dumps({"type": "log", "agent": "System", "message": "All tasks done!", "log_type": "success"}).decode())
+
+    async def _broadcast_token(self, step_action, delta):
+        await self.ws_manager.broadcast(orjson.dumps({"type": "token", "agent": "KnowledgeAgent", "step_action": step_action, "delta": delta}).decode())
+
+    async def _auto_save(self, filename, msg, action):
+        await self.knowledge_agent.add_knowledge(filename, msg)
+        await self.ws_manager.broadcast(orjson.dumps({
+            "type": "log", 
+            "agent": "KnowledgeAgent", 
+            "message": f"Auto-saved results for '{action}' to knowledge base.", 
+            "log_type": "info"
+        }).decode())
+
+    async def _do_knowledge(self, action):
+        if "add knowledge" in action.lower():
+            match = _ADD_KNOW_RE.search(action)
+            return await self.knowledge_agent.add_knowledge(match.group(2), match.group(1)) if match else "Parse Error"
+        # Questions should see any search results still being saved
+        if self._pending: await asyncio.gather(*self._pending)
+        return await self.knowledge_agent.run(action, on_token=partial(self._broadcast_token, action))
+
+    async def _do_search(self, action):
+        msg = await self.search_agent.run(action)
+        # --- AUTO-SAVE LOGIC ---
+        # Whenever we search, we save the result to the knowledge base immediately
+        filename = _FILENAME_RE.sub('_', action[:20]) # Create filename from search query
+        # Saved in the background so the next steps don't wait on it
+        save_task = asyncio.create_task(self._auto_save(filename, msg, action))
+        self._pending.add(save_task)
+        save_task.add_done_callback(self._pending.discard)
+        return msg
+
+    async def _do_calendar(self, action):
+        return f"Event: {await self.calendar_agent.run(self._parse_calendar_action(action))}"
 
     async def _execute_step(self, agent, action):
-        await self.ws_manager.broadcast(json.dumps({"type": "status_update", "step_action": action, "status": "in-progress"}))
+        await self.ws_manager.broadcast(orjson.dumps({"type": "status_update", "step_action": action, "status": "in-progress"}).decode())
+        events = [] # Flushed to the clients as a single frame when the step ends
         
         try:
-            msg = ""
-            if agent == "KnowledgeAgent":
-                if "add knowledge" in action.lower():
-                    match = re.search(r"knowledge:\s*['\"](.+?)['\"]\s*in\s+([^\s]+)", action, re.IGNORECASE)
-                    msg = await self.knowledge_agent.add_knowledge(match.group(2), match.group(1)) if match else "Parse Error"
-                else:
-                    msg = await self.knowledge_agent.run(action)
-
-            elif agent == "SearchAgent":
-                msg = await self.search_agent.run(action)
-                # --- AUTO-SAVE LOGIC ---
-                # Whenever we search, we save the result to the knowledge base immediately
-                filename = re.sub(r'[^a-zA-Z0-9]', '_', action[:20]) # Create filename from search query
-                await self.knowledge_agent.add_knowledge(filename, msg)
-                await self.ws_manager.broadcast(json.dumps({
-                    "type": "log", 
-                    "agent": "KnowledgeAgent", 
-                    "message": f"Auto-saved results for '{action}' to knowledge base.", 
-                    "log_type": "info"
-                }))
-
-            elif agent == "SlackAgent":
-                msg = await self.slack_agent.execute(action)
-
-            elif agent == "CommunicationAgent":
-                msg = await self.communication_agent.run(action)
-
-            elif agent == "CalendarAgent":
-                msg = f"Event: {await self.calendar_agent.run(self._parse_calendar_action(action))}"
-            
-            else:
-                msg = f"Task completed by {agent}"
+            handler = self._dispatch.get(agent)
+            msg = await handler(action) if handler else f"Task completed by {agent}"
 
-            await self.ws_manager.broadcast(json.dumps({"type": "status_update", "step_action": action, "status": "completed"}))
-            await self.ws_manager.broadcast(json.dumps({"type": "log", "agent": agent, "message": msg, "log_type": "info"}))
+            events.append({"type": "status_update", "step_action": action, "status": "completed"})
+            events.append({"type": "log", "agent": agent, "step_action": action, "message": msg, "log_type": "info"})
+            await self.ws_manager.broadcast_many(events)
             return msg
 
         except Exception as e:
-            await self.ws_manager.broadcast(json.dumps({"type": "log", "agent": agent, "message": f"Error: {e}", "log_type": "error"}))
+            events.append({"type": "log", "agent": agent, "step_action": action, "message": f"Error: {e}", "log_type": "error"})
+            await self.ws_manager.broadcast_many(events)
             return f"Error: {str(e)}"
\ No newline at end of file